@@ -4,14 +4,33 @@ When a request sent by the client includes an Accept-Encoding header, the
 server handles the value (eg "gzip", "x-gzip" or "deflate") and tries to
 compress the response body with the requested algorithm.
 
+If the package isal (https://pypi.org/project/isal/) is installed, it is used
+instead of the zlib module for gzip and deflate compression. The "br" and
+"zstd" encodings are supported if the packages brotli and zstandard are
+installed.
+
 Class HTTPCompressionRequestHandler extends SimpleHTTPRequestHandler with
-2 additional attributes:
-- compressed_types: the list of mimetypes that will be returned compressed by
-  the server. By default, it is set to a list of commonly compressed types.
+additional attributes, among which:
+- compressed_types: the collection of mimetypes that will be returned
+  compressed by the server. By default, it is set to the commonly compressed
+  types.
+- min_compressed_size: files smaller than this size are never compressed.
 - compressions: a mapping between an Accept-Encoding value and a generator
-  that produces compressed data.
-
-Chunked Transfer Encoding is used to send the compressed response.
+  that produces compressed data, in order of preference.
+- use_mmap: if True, big files are compressed from a memory mapping. Off by
+  default: truncating a file while it is sent would crash the server.
+- compression_level: the compression level for gzip and deflate (1 by
+  default, favouring speed over compression ratio).
+- precompressed_suffixes: a mapping between an encoding and the suffix of
+  precompressed files (eg "script.js.gz"), sent instead of compressing the
+  original file.
+- cache_dir: if set, a directory where compressed files are stored, to avoid
+  compressing the same file again for later requests.
+- max_buffered_size: files smaller than this size are compressed in memory
+  and sent with a Content-Length header.
+
+Chunked Transfer Encoding is used to send the compressed response of bigger
+files.
 """
 
 __version__ = "0.3"
@@ -20,33 +39,69 @@ __all__ = [
     "ThreadingHTTPServer", "HTTPCompressionRequestHandler"
 ]
 
-import datetime
 import email.utils
-import http.cookiejar
-import io
+import functools
+import hashlib
+import mimetypes
 import os
+import posixpath
+import re
 import socket
 import socketserver
 import sys
+import tempfile
 import urllib.parse
-from functools import partial
 
 from http import HTTPStatus
 from http.server import (HTTPServer, BaseHTTPRequestHandler,
     SimpleHTTPRequestHandler, CGIHTTPRequestHandler,
     _url_collapse_path, test)
 
-# Python might be built without zlib
+# Python might be built without zlib. If the optional package isal is
+# installed, use its faster, zlib-compatible implementation of DEFLATE.
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    try:
+        import zlib
+    except ImportError:
+        zlib = None
+
+# mmap is not available on all platforms
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+# Optional packages for brotli and zstd compression
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 try:
-    import zlib
+    import zstandard
 except ImportError:
-    zlib = None
+    zstandard = None
 
 
 DEFAULT_BIND = '0.0.0.0'
 
+# Socket option that holds back partial TCP segments; only available on
+# Linux
+_TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+# End of line in Chunked Transfer Encoding
+_CRLF = b"\r\n"
 
-# List of commonly compressed content types, copied from
+# Maximum number of buffers sent in a single call to sendmsg()
+_IOV_MAX = 1024
+
+# Encodings that are aliases of another one (RFC 9110, section 8.4.1.3)
+_ENCODING_ALIASES = {'x-gzip': 'gzip'}
+
+
+# List of commonly compressed content types, adapted from
 # https://github.com/h5bp/server-configs-apache.
 commonly_compressed_types = [
     "application/atom+xml",
@@ -58,18 +113,11 @@ commonly_compressed_types = [
     "application/rss+xml",
     "application/schema+json",
     "application/vnd.geo+json",
-    "application/vnd.ms-fontobject",
-    "application/x-font-ttf",
     "application/x-javascript",
     "application/x-web-app-manifest+json",
     "application/xhtml+xml",
     "application/xml",
-    "font/eot",
-    "font/opentype",
-    "image/bmp",
     "image/svg+xml",
-    "image/vnd.microsoft.icon",
-    "image/x-icon",
     "text/cache-manifest",
     "text/css",
     "text/html",
@@ -83,30 +131,181 @@ commonly_compressed_types = [
     "text/xml"
 ]
 
+# Font and icon types, which are usually already compressed or get little
+# benefit from HTTP compression. Add them to compressed_types to compress
+# them anyway.
+marginally_compressed_types = [
+    "application/vnd.ms-fontobject",
+    "application/x-font-ttf",
+    "font/eot",
+    "font/opentype",
+    "image/bmp",
+    "image/vnd.microsoft.icon",
+    "image/x-icon"
+]
+
 # Generators for HTTP compression
 
-def _zlib_producer(fileobj, wbits):
+# Size of the blocks read from the file by the built-in producers
+DEFAULT_BUFSIZE = 1 << 20
+
+# Compression level used for gzip and deflate. Level 1 is several times
+# faster than the zlib default (6) and compresses text only slightly less.
+DEFAULT_COMPRESSION_LEVEL = 1
+
+def _compress_blocks(fileobj, bufsize, compress):
+    """Generator that yields compress(block) for the successive blocks of
+    bufsize bytes read from fileobj. If fileobj is a memory-mapped file, the
+    blocks are slices of the mapping, passed to compress without copying."""
+    if mmap and isinstance(fileobj, mmap.mmap):
+        with memoryview(fileobj) as view:
+            for start in range(0, len(view), bufsize):
+                yield compress(view[start:start + bufsize])
+    else:
+        while True:
+            buf = fileobj.read(bufsize)
+            if not buf: # end of file
+                return
+            yield compress(buf)
+
+def _zlib_producer(fileobj, wbits, bufsize=DEFAULT_BUFSIZE,
+        level=DEFAULT_COMPRESSION_LEVEL):
     """Generator that yields data read from the file object fileobj,
     compressed with the zlib library.
     wbits is the same argument as for zlib.compressobj.
+    bufsize is the size of the blocks read from fileobj.
+    level is the compression level.
     """
-    bufsize = 2 << 17
-    producer = zlib.compressobj(wbits=wbits)
+    # A compression object can't be reset after flush(), so a new one is
+    # created for each response; this takes a few microseconds, much less
+    # than copying a pooled object with copy().
+    producer = zlib.compressobj(level, zlib.DEFLATED, wbits)
     with fileobj:
-        while True:
-            buf = fileobj.read(bufsize)
-            if not buf: # end of file
-                yield producer.flush()
-                return
-            yield producer.compress(buf)
+        yield from _compress_blocks(fileobj, bufsize, producer.compress)
+        yield producer.flush()
 
-def _gzip_producer(fileobj):
+def _gzip_producer(fileobj, bufsize=DEFAULT_BUFSIZE,
+        level=DEFAULT_COMPRESSION_LEVEL):
     """Generator for gzip compression."""
-    return _zlib_producer(fileobj, 31)
+    return _zlib_producer(fileobj, 31, bufsize, level)
 
-def _deflate_producer(fileobj):
+def _deflate_producer(fileobj, bufsize=DEFAULT_BUFSIZE,
+        level=DEFAULT_COMPRESSION_LEVEL):
     """Generator for deflate compression."""
-    return _zlib_producer(fileobj, 15)
+    return _zlib_producer(fileobj, 15, bufsize, level)
+
+def _brotli_producer(fileobj, bufsize=DEFAULT_BUFSIZE):
+    """Generator for brotli compression."""
+    # The default quality (11) is much too slow for on-the-fly compression
+    producer = brotli.Compressor(quality=4)
+    with fileobj:
+        yield from _compress_blocks(fileobj, bufsize, producer.process)
+        yield producer.finish()
+
+def _zstd_producer(fileobj, bufsize=DEFAULT_BUFSIZE):
+    """Generator for zstd compression."""
+    producer = zstandard.ZstdCompressor(level=3).compressobj()
+    with fileobj:
+        yield from _compress_blocks(fileobj, bufsize, producer.compress)
+        yield producer.flush()
+
+def _caching_producer(producer, cache_path):
+    """Generator that yields the data produced by producer and stores it in
+    the file cache_path. The file is only created when producer is exhausted;
+    if it can't be written, the data is yielded without being cached."""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+    except OSError:
+        # cache directory is not writable
+        yield from producer
+        return
+    cache = open(fd, 'wb')
+    caching = True
+    complete = False
+    try:
+        for data in producer:
+            if caching:
+                try:
+                    cache.write(data)
+                except OSError:
+                    caching = False
+            yield data
+        complete = caching
+    finally:
+        producer.close()
+        try:
+            cache.close()
+        except OSError:
+            # buffered data could not be written
+            complete = False
+        try:
+            if complete:
+                os.replace(tmp_path, cache_path)
+            else:
+                # write error, or the client closed the connection
+                os.unlink(tmp_path)
+        except OSError:
+            pass
+
+# Producers defined in this module accept the additional argument bufsize
+_builtin_producers = (_gzip_producer, _deflate_producer, _brotli_producer,
+    _zstd_producer)
+
+# zlib producers also accept the argument level
+_zlib_producers = (_gzip_producer, _deflate_producer)
+
+
+# Encoding and optional quality in an item of an Accept-Encoding header
+_accept_encoding_re = re.compile(
+    r"\s*([^\s,;]+)\s*(?:;\s*q\s*=\s*([^\s,;]*))?")
+
+@functools.lru_cache(maxsize=256)
+def _parse_accept_encoding(header):
+    """Return a dictionary mapping the encodings in the value of an
+    Accept-Encoding header to their quality. Encodings refused by the client
+    have quality 0.
+    Clients send the same header for all their requests, so the result is
+    cached: it must not be modified.
+    """
+    encodings = {}
+    for item in header.split(","):
+        match = _accept_encoding_re.match(item)
+        if match is None: # empty item
+            continue
+        encoding, value = match.groups()
+        if value:
+            value = value.strip('"') # quoted value, eg q="0.5"
+        if not value:
+            q = 1 # quality defaults to 1, also for an empty value
+        else:
+            try:
+                q = float(value)
+            except ValueError:
+                # Invalid quality : ignore encoding
+                continue
+        encodings[encoding] = max(encodings.get(encoding, 0), q)
+    return encodings
+
+
+@functools.lru_cache(maxsize=4096)
+def _guess_mimetype(path):
+    """Cached version of mimetypes.guess_type(path)[0]."""
+    return mimetypes.guess_type(path)[0]
+
+@functools.lru_cache(maxsize=4096)
+def _http_date(timestamp):
+    """Return the HTTP date for the integer timestamp, as used in the
+    Last-Modified header. Static files share a few modification times, so
+    the formatted dates are cached."""
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+class _Buffers(list):
+    """List of the pieces of data that make a response body, returned by
+    send_head() for compressed data held in memory."""
+
+    def close(self):
+        pass
 
 
 class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
@@ -121,45 +320,237 @@ class HTTPCompressionRequestHandler(SimpleHTTPRequestHandler):
     server_version = "CompressionHTTP/" + __version__
 
     # List of Content Types that are returned with HTTP compression.
-    # Set to the commonly_compressed_types by default.
-    compressed_types = commonly_compressed_types
+    # Set to the commonly_compressed_types by default, as a frozenset for
+    # fast lookups; subclasses can use any container.
+    compressed_types = frozenset(commonly_compressed_types)
+
+    # Files smaller than this size are not compressed: the Content-Encoding
+    # header and the compression overhead would exceed the savings on such a
+    # small response, which fits in a single TCP packet anyway.
+    min_compressed_size = 1400
 
     # Dictionary mapping an encoding (in an Accept-Encoding header) to a
     # generator of compressed data. By default, provided zlib is available,
-    # the supported encodings are gzip and deflate.
+    # the supported encodings are gzip and deflate; br and zstd are also
+    # supported if the packages brotli and zstandard are installed.
+    # The order of the keys is the order of preference when the client
+    # accepts several encodings with the same quality.
     # Override if a subclass wants to use other compression algorithms.
     compressions = {}
+    if brotli:
+        compressions['br'] = _brotli_producer
+    if zstandard:
+        compressions['zstd'] = _zstd_producer
     if zlib:
-        compressions = {
-            'deflate': _deflate_producer,
+        compressions.update({
             'gzip': _gzip_producer,
+            'deflate': _deflate_producer,
             'x-gzip': _gzip_producer # alias for gzip
-        }
+        })
+
+    # Mapping between an encoding and the suffix of precompressed files, eg
+    # "script.js.gz" for "script.js" with gzip. If such a file exists and is
+    # not older than the original file, it is sent instead of compressing
+    # the original file.
+    precompressed_suffixes = {
+        'br': '.br',
+        'zstd': '.zst',
+        'gzip': '.gz',
+        'x-gzip': '.gz'
+    }
+
+    # Size of the file object returned by send_head(), as sent in the
+    # Content-Length header
+    _content_length = None
+
+    # Directory where compressed files are stored, to be sent again without
+    # compressing them as long as the original file is not modified. Set to
+    # None (the default) to always compress on the fly. Obsolete versions
+    # are not removed from the directory.
+    cache_dir = None
+
+    # Size of the blocks read from the file by the built-in producers.
+    read_bufsize = DEFAULT_BUFSIZE
+
+    # If True, files of at least max_buffered_size are compressed from a
+    # memory mapping instead of being read, which avoids copying their
+    # content. Disabled by default: if a file is truncated while it is
+    # sent, eg when it is rewritten in place, the server process is killed
+    # by a SIGBUS signal.
+    use_mmap = False
+
+    # Compression level for gzip and deflate, from 1 (fastest) to 9 (best
+    # compression), or 0 to 3 if isal is used. Higher levels reduce the size
+    # of responses at a much higher CPU cost: on a fast network, the server
+    # is limited by compression speed, and level 1 is the best tradeoff. A
+    # higher level may be worth it on slow links or with cache_dir, where
+    # each file is only compressed once.
+    compression_level = DEFAULT_COMPRESSION_LEVEL
+
+    # With Chunked Transfer Encoding, compressed data is sent when at least
+    # write_batch_size bytes are available, or after write_batch_chunks
+    # chunks.
+    write_batch_size = 1 << 16
+    write_batch_chunks = 16
+
+    # Files smaller than this size are compressed in memory and sent with a
+    # Content-Length header; bigger files are sent as a stream of compressed
+    # data, with Chunked Transfer Encoding if the protocol supports it.
+    max_buffered_size = 8 << 20
 
     def do_GET(self):
         """Serve a GET request."""
+        # With keep-alive, the handler serves several requests: don't use
+        # the size of a previous response.
+        self._content_length = None
         f = self.send_head()
         if f:
             try:
-                if hasattr(f, "read"):
-                    self.copyfile(f, self.wfile)
+                if isinstance(f, _Buffers):
+                    self._write_buffers(f)
+                elif hasattr(f, "read"):
+                    if isinstance(self.connection, socket.socket):
+                        # Use os.sendfile() if possible: socket.sendfile()
+                        # falls back to send() for other file objects.
+                        # Never send more than the Content-Length, even if
+                        # the file grew in the meantime.
+                        self.wfile.flush()
+                        self.connection.sendfile(f,
+                            count=self._content_length)
+                    else:
+                        self.copyfile(f, self.wfile)
                 else:
                     # Generator for compressed data
                     if self.protocol_version >= "HTTP/1.1":
-                        # Chunked Transfer
+                        # Chunked Transfer. Small chunks are sent together
+                        # to reduce the number of system calls.
+                        make_chunk = self._make_chunk
+                        write_buffers = self._write_buffers
+                        batch_size = self.write_batch_size
+                        batch_chunks = self.write_batch_chunks
+                        pending = []
+                        pending_size = 0
+                        pending_chunks = 0
                         for data in f:
                             if data:
-                                self.wfile.write(self._make_chunk(data))
-                        self.wfile.write(self._make_chunk(b''))
+                                pending += make_chunk(data)
+                                pending_size += len(data)
+                                pending_chunks += 1
+                                if (pending_size >= batch_size
+                                        or pending_chunks >= batch_chunks):
+                                    write_buffers(pending)
+                                    pending = []
+                                    pending_size = 0
+                                    pending_chunks = 0
+                        pending += make_chunk(b'')
+                        write_buffers(pending)
                     else:
+                        write = self.wfile.write
                         for data in f:
-                            self.wfile.write(data)
+                            write(data)
+                    # Send the last partial TCP segment
+                    self._set_cork(False)
             finally:
                 f.close()
 
+    def guess_type(self, path):
+        """Guess the type of a file, like SimpleHTTPRequestHandler.guess_type,
+        caching the results of mimetypes.guess_type()."""
+        base, ext = posixpath.splitext(path)
+        if ext in self.extensions_map:
+            return self.extensions_map[ext]
+        ext = ext.lower()
+        if ext in self.extensions_map:
+            return self.extensions_map[ext]
+        return (_guess_mimetype(path)
+            or self.extensions_map.get('', 'application/octet-stream'))
+
+    def _make_producer(self, compression, fileobj):
+        """Return the generator of data read from fileobj, compressed with
+        the algorithm registered for compression in self.compressions."""
+        producer = self.compressions[compression]
+        if producer in _zlib_producers:
+            return producer(fileobj, bufsize=self.read_bufsize,
+                level=self.compression_level)
+        if producer in _builtin_producers:
+            return producer(fileobj, bufsize=self.read_bufsize)
+        return producer(fileobj)
+
+    def _cache_path(self, path, fs, compression):
+        """Return the path of the file in self.cache_dir that stores the
+        content of the file at path, compressed with compression. fs is
+        the result of os.fstat() for this file: the path changes when the
+        file is modified, or when the compression level is changed."""
+        key = (f"{path}:{fs.st_mtime_ns}:{compression}:"
+            f"{self.compression_level}").encode("utf-8", "surrogateescape")
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+    def _open_compressed(self, path, fs, compression):
+        """Return a file object for the content of the file at path, already
+        compressed with compression, or None if there is no such file. The
+        content is read from a precompressed file next to the original file,
+        or from the cache directory. fs is the result of os.fstat() for the
+        file at path."""
+        suffix = self.precompressed_suffixes.get(compression)
+        if suffix is not None:
+            try:
+                f = open(path + suffix, 'rb')
+            except OSError:
+                pass
+            else:
+                if os.fstat(f.fileno()).st_mtime >= fs.st_mtime:
+                    return f
+                # ignore precompressed files older than the original file
+                f.close()
+        if self.cache_dir is not None:
+            try:
+                return open(self._cache_path(path, fs, compression), 'rb')
+            except OSError:
+                pass
+        return None
+
+    def _set_cork(self, value):
+        """Set the option TCP_CORK of the connection to value, if the
+        platform supports it. While it is set, partial TCP segments are held
+        back; clearing it sends them."""
+        if _TCP_CORK is None or not isinstance(self.connection, socket.socket):
+            return
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, value)
+        except OSError:
+            # eg not a TCP socket
+            pass
+
     def _make_chunk(self, data):
-        """Make a data chunk in Chunked Transfer Encoding format."""
-        return f"{len(data):X}".encode("ascii") + b"\r\n" + data + b"\r\n"
+        """Make a data chunk in Chunked Transfer Encoding format.
+        Return a tuple (size line, data, line ending), to be sent by
+        _write_buffers() without copying data."""
+        return b"%X\r\n" % len(data), data, _CRLF
+
+    def _write_buffers(self, buffers):
+        """Write the bytes-like objects in buffers to the client, with a
+        single sendmsg() call if the connection supports it."""
+        self.wfile.flush()
+        sendmsg = getattr(self.connection, "sendmsg", None)
+        if sendmsg is not None and isinstance(self.connection, socket.socket):
+            views = [memoryview(buf) for buf in buffers if buf]
+            try:
+                sent = sendmsg(views[:_IOV_MAX])
+            except NotImplementedError:
+                # eg SSL sockets
+                pass
+            else:
+                while True:
+                    # handle partial writes
+                    while views and sent >= views[0].nbytes:
+                        sent -= views.pop(0).nbytes
+                    if not views:
+                        return
+                    views[0] = views[0][sent:]
+                    sent = sendmsg(views[:_IOV_MAX])
+        for buf in buffers:
+            self.wfile.write(buf)
+        self.wfile.flush()
 
     def send_head(self):
         """Common code for GET and HEAD commands.
@@ -171,6 +562,9 @@ class HTTPCompressionRequestHandler(SimpleHTTPRequestHandler):
         caller unless the command was HEAD, and must be closed by the caller
         under all circumstances)
         - a generator of pieces of compressed data if HTTP compression is used
+        for a big file
+        - a list of pieces of compressed data if HTTP compression is used for
+        a small file
         - None, in which case the caller has nothing further to do
         """
         path = self.translate_path(self.path)
@@ -194,6 +588,36 @@ class HTTPCompressionRequestHandler(SimpleHTTPRequestHandler):
             else:
                 return self.list_directory(path)
         ctype = self.guess_type(path)
+        try:
+            fs = os.stat(path)
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        # Use browser cache if possible
+        if ("If-Modified-Since" in self.headers
+                and "If-None-Match" not in self.headers):
+            # compare If-Modified-Since and time of last file modification,
+            # as integer POSIX timestamps
+            try:
+                ims = email.utils.parsedate_tz(
+                    self.headers["If-Modified-Since"])
+                if ims[9] is None:
+                    # obsolete format with no timezone, cf.
+                    # https://tools.ietf.org/html/rfc7231#section-7.1.1.1
+                    ims = ims[:9] + (0,)
+                ims = email.utils.mktime_tz(ims)
+            except (TypeError, IndexError, OverflowError, ValueError):
+                # ignore ill-formed values
+                pass
+            else:
+                # If-Modified-Since has no microseconds
+                if int(fs.st_mtime) <= ims:
+                    # the file doesn't need to be opened
+                    self.send_response(HTTPStatus.NOT_MODIFIED)
+                    self.end_headers()
+                    return None
+
         try:
             f = open(path, 'rb')
         except OSError:
@@ -201,44 +625,22 @@ class HTTPCompressionRequestHandler(SimpleHTTPRequestHandler):
             return None
 
         try:
+            # The file may have been replaced since os.stat(): the headers
+            # must describe the file that was opened.
             fs = os.fstat(f.fileno())
-            content_length = fs[6]
-            # Use browser cache if possible
-            if ("If-Modified-Since" in self.headers
-                    and "If-None-Match" not in self.headers):
-                # compare If-Modified-Since and time of last file modification
-                try:
-                    ims = email.utils.parsedate_to_datetime(
-                        self.headers["If-Modified-Since"])
-                except (TypeError, IndexError, OverflowError, ValueError):
-                    # ignore ill-formed values
-                    pass
-                else:
-                    if ims.tzinfo is None:
-                        # obsolete format with no timezone, cf.
-                        # https://tools.ietf.org/html/rfc7231#section-7.1.1.1
-                        ims = ims.replace(tzinfo=datetime.timezone.utc)
-                    if ims.tzinfo is datetime.timezone.utc:
-                        # compare to UTC datetime of last modification
-                        last_modif = datetime.datetime.fromtimestamp(
-                            fs.st_mtime, datetime.timezone.utc)
-                        # remove microseconds, like in If-Modified-Since
-                        last_modif = last_modif.replace(microsecond=0)
-
-                        if last_modif <= ims:
-                            self.send_response(HTTPStatus.NOT_MODIFIED)
-                            self.end_headers()
-                            f.close()
-                            return None
-
+            content_length = fs.st_size
             self.send_response(HTTPStatus.OK)
             self.send_header("Content-type", ctype)
-            self.send_header("Last-Modified",
-                self.date_time_string(fs.st_mtime))
+            self.send_header("Last-Modified", _http_date(int(fs.st_mtime)))
 
-            if ctype not in self.compressed_types:
+            accept_encoding = self.headers.get_all("Accept-Encoding")
+            if (ctype not in self.compressed_types
+                    or content_length < self.min_compressed_size
+                    or not accept_encoding
+                    or not self.compressions):
                 self.send_header("Content-Length", str(content_length))
                 self.end_headers()
+                self._content_length = content_length
                 return f
 
             # Use HTTP compression if possible
@@ -246,52 +648,77 @@ class HTTPCompressionRequestHandler(SimpleHTTPRequestHandler):
             # Get accepted encodings ; "encodings" is a dictionary mapping
             # encodings to their quality ; eg for header "gzip; q=0.8",
             # encodings["gzip"] is set to 0.8
-            accept_encoding = self.headers.get_all("Accept-Encoding", ())
-            encodings = {}
-            for accept in http.cookiejar.split_header_words(accept_encoding):
-                params = iter(accept)
-                encoding = next(params, ("", ""))[0]
-                quality, value = next(params, ("", ""))
-                if quality == "q" and value:
-                    try:
-                        q = float(value)
-                    except ValueError:
-                        # Invalid quality : ignore encoding
-                        q = 0
-                else:
-                    q = 1 # quality defaults to 1
-                if q:
-                    encodings[encoding] = max(encodings.get(encoding, 0), q)
+            encodings = _parse_accept_encoding(", ".join(accept_encoding))
 
-            compressions = set(encodings).intersection(self.compressions)
+            # Take the supported encoding with highest quality ; for equal
+            # qualities, take the first one in self.compressions.
             compression = None
-            if compressions:
-                # Take the encoding with highest quality
-                compression = max((encodings[enc], enc)
-                    for enc in compressions)[1]
-            elif '*' in encodings and self.compressions:
+            best_q = 0
+            for enc in self.compressions:
+                q = encodings.get(enc, 0)
+                if q > best_q:
+                    best_q, compression = q, enc
+            if compression is None and encodings.get('*'):
                 # If no specified encoding is supported but "*" is accepted,
-                # take one of the available compressions.
-                compression = list(self.compressions)[0]
+                # take the first of the available compressions that the
+                # client didn't refuse (with quality 0). Refusing an
+                # encoding also refuses its aliases.
+                refused = {_ENCODING_ALIASES.get(enc, enc)
+                    for enc in encodings}
+                compression = next((enc for enc in self.compressions
+                    if _ENCODING_ALIASES.get(enc, enc) not in refused),
+                    None)
             if compression:
                 # If at least one encoding is accepted, send data compressed
                 # with the selected compression algorithm.
-                producer = self.compressions[compression]
                 self.send_header("Content-Encoding", compression)
-                if content_length < 2 << 18:
-                    # For small files, load content in memory
+                compressed = self._open_compressed(path, fs, compression)
+                if compressed is not None:
+                    # Send the file content already compressed
+                    f.close()
+                    f = compressed
+                    content_length = os.fstat(f.fileno()).st_size
+                    self.send_header("Content-Length", str(content_length))
+                    self.end_headers()
+                    self._content_length = content_length
+                    return f
+                cache_path = None
+                if self.cache_dir is not None:
+                    cache_path = self._cache_path(path, fs, compression)
+                if (self.use_mmap and mmap
+                        and content_length >= self.max_buffered_size):
+                    # Compress big files from a memory mapping, which avoids
+                    # copying the file content to Python bytes objects
+                    try:
+                        mapped = mmap.mmap(f.fileno(), 0,
+                            access=mmap.ACCESS_READ)
+                    except (OSError, ValueError):
+                        pass
+                    else:
+                        f.close()
+                        f = mapped
+                producer = self._make_producer(compression, f)
+                if cache_path is not None:
+                    producer = _caching_producer(producer, cache_path)
+                if content_length < self.max_buffered_size:
+                    # For small files, load content in memory. The pieces
+                    # of compressed data are sent without joining them.
                     with f:
-                        content = b''.join(producer(f))
-                    content_length = len(content)
-                    f = io.BytesIO(content)
+                        content = _Buffers(data for data in producer if data)
+                    content_length = sum(map(len, content))
+                    f = content
                 else:
                     chunked = self.protocol_version >= "HTTP/1.1"
                     if chunked:
                         # Use Chunked Transfer Encoding (RFC 7230 section 4.1)
                         self.send_header("Transfer-Encoding", "chunked")
+                    if self.command == "GET":
+                        # Send the headers in the same TCP segments as the
+                        # first data ; do_GET() uncorks the connection.
+                        self._set_cork(True)
                     self.end_headers()
                     # Return a generator of pieces of compressed data
-                    return producer(f)
+                    return producer
 
             self.send_header("Content-Length", str(content_length))
             self.end_headers()
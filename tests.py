@@ -18,6 +18,9 @@ import re
 import base64
 import ntpath
 import shutil
+import socket
+import errno
+import io
 import email.message
 import email.utils
 import html
@@ -44,6 +47,16 @@ try:
 except ImportError:
     bz2 = None
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 class NoLogRequestHandler:
     def log_message(self, *args):
         # don't write log messages to stderr
@@ -494,6 +507,21 @@ class SimpleHTTPServerTestCase(BaseTestCase):
         response = self.request(self.base_url + '/test', headers=headers)
         self.check_status_and_reason(response, HTTPStatus.NOT_MODIFIED)
 
+        # same date in another timezone : must return 304
+        tz = datetime.timezone(datetime.timedelta(hours=2))
+        headers = email.message.Message()
+        headers['If-Modified-Since'] = email.utils.format_datetime(
+            self.last_modif_datetime.astimezone(tz))
+        response = self.request(self.base_url + '/test', headers=headers)
+        self.check_status_and_reason(response, HTTPStatus.NOT_MODIFIED)
+
+        # obsolete asctime() format with no timezone, interpreted as UTC
+        headers = email.message.Message()
+        headers['If-Modified-Since'] = self.last_modif_datetime.strftime(
+            '%a %b %d %H:%M:%S %Y')
+        response = self.request(self.base_url + '/test', headers=headers)
+        self.check_status_and_reason(response, HTTPStatus.NOT_MODIFIED)
+
     def test_browser_cache_file_changed(self):
         # with If-Modified-Since earlier than Last-Modified, must return 200
         dt = self.last_modif_datetime
@@ -584,7 +612,7 @@ class HTTPCompressionTestCase(BaseTestCase):
         self.cwd = os.getcwd()
         basetempdir = tempfile.gettempdir()
         os.chdir(basetempdir)
-        self.data = 10 * b'We are the knights who say Ni!'
+        self.data = 50 * b'We are the knights who say Ni!'
         self.tempdir = tempfile.mkdtemp(dir=basetempdir)
         self.tempdir_name = os.path.basename(self.tempdir)
         self.base_url = '/' + self.tempdir_name
@@ -595,13 +623,18 @@ class HTTPCompressionTestCase(BaseTestCase):
         with open(os.path.join(self.tempdir, 'test.abc'), 'wb') as temp:
             temp.write(self.data)
 
+        self.tiny_data = b'Ni!'
+        with open(os.path.join(self.tempdir, 'tiny.txt'), 'wb') as temp:
+            temp.write(self.tiny_data)
+
         for ext in self.compressible_ext:
             path = os.path.join(self.tempdir, 'test.{}'.format(ext))
             with open(path, 'wb') as temp:
                 temp.write(self.data)
 
-        # create big files, size > 2 << 18
-        self.repeat = (2 << 19) // len(self.data)
+        # create big files, size > max_buffered_size
+        self.repeat = 2 * self.request_handler.max_buffered_size \
+            // len(self.data)
         for ext in self.compressible_ext:
             path = os.path.join(self.tempdir, 'test_big.{}'.format(ext))
             with open(path, 'wb') as temp:
@@ -632,6 +665,27 @@ class HTTPCompressionTestCase(BaseTestCase):
         self.assertNotIn('Content-Encoding', response.headers)
         self.assertEqual(response.read(), self.data)
 
+    def test_file_replaced(self):
+        # if the file is replaced between os.stat() and open(), the headers
+        # describe the file that is actually sent
+        path = os.path.join(self.tempdir, 'test.abc')
+        new_data = 3 * self.data
+
+        def replace_and_open(name, *args):
+            if name == path:
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'wb') as temp:
+                    temp.write(new_data)
+                os.replace(tmp_path, path)
+            return open(name, *args)
+
+        with mock.patch.object(server, 'open', replace_and_open,
+                create=True):
+            response = self.request(self.base_url + '/test.abc')
+            self.assertEqual(response.headers['Content-Length'],
+                str(len(new_data)))
+            self.assertEqual(response.read(), new_data)
+
     @unittest.skipIf(zlib is None, 'zlib is not available')
     def test_header_set_unsupported_extension(self):
         # no file extension
@@ -646,6 +700,14 @@ class HTTPCompressionTestCase(BaseTestCase):
         self.assertNotIn('Content-Encoding', response.headers)
         self.assertEqual(response.read(), self.data)
 
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_header_set_tiny_file(self):
+        # files smaller than min_compressed_size are not compressed
+        response = self.request(self.base_url + '/tiny.txt',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.read(), self.tiny_data)
+
     @unittest.skipIf(zlib is None, 'zlib is not available')
     def test_header_set_supported_extension(self):
         # Accept-Encoding header set, compressible file extension
@@ -703,6 +765,155 @@ class HTTPCompressionTestCase(BaseTestCase):
             self.assertEqual(gzip.decompress(response.read()),
                 self.repeat * self.data)
 
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_compression_level(self):
+        # levels 0 to 3 are supported by both zlib and isal
+        try:
+            for level in range(4):
+                self.request_handler.compression_level = level
+                for name in ('test.txt', 'test_big.txt'):
+                    response = self.request(self.base_url + '/' + name,
+                        headers={'Accept-Encoding': 'gzip'})
+                    self.assertEqual(response.headers['Content-Encoding'],
+                        'gzip')
+                    self.assertEqual(gzip.decompress(response.read()),
+                        self.data if name == 'test.txt'
+                        else self.repeat * self.data)
+        finally:
+            del self.request_handler.compression_level
+
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_use_mmap(self):
+        self.request_handler.use_mmap = True
+        try:
+            for ext in self.compressible_ext:
+                response = self.request(
+                    self.base_url + '/test_big.{}'.format(ext),
+                    headers={'Accept-Encoding': 'gzip'})
+                self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+                self.assertEqual(gzip.decompress(response.read()),
+                    self.repeat * self.data)
+        finally:
+            del self.request_handler.use_mmap
+
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_precompressed_file(self):
+        # a precompressed file is sent instead of compressing the file
+        path = os.path.join(self.tempdir, 'test.txt')
+        precompressed = gzip.compress(b'precompressed ' + self.data)
+        with open(path + '.gz', 'wb') as temp:
+            temp.write(precompressed)
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Content-Length'],
+            str(len(precompressed)))
+        self.assertEqual(response.read(), precompressed)
+
+        # precompressed files are only used for the matching encoding
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.read()), self.data)
+
+        # precompressed files older than the file are ignored
+        mtime = os.stat(path).st_mtime_ns - 10 ** 9
+        os.utime(path + '.gz', ns=(mtime, mtime))
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(gzip.decompress(response.read()), self.data)
+
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        self.request_handler.cache_dir = cache_dir
+        try:
+            for name, data in (('test.txt', self.data),
+                    ('test_big.txt', self.repeat * self.data)):
+                for _ in range(2):
+                    response = self.request(self.base_url + '/' + name,
+                        headers={'Accept-Encoding': 'gzip'})
+                    self.assertEqual(response.headers['Content-Encoding'],
+                        'gzip')
+                    self.assertEqual(gzip.decompress(response.read()), data)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # a new version of the file is cached separately
+            path = os.path.join(self.tempdir, 'test.txt')
+            mtime = os.stat(path).st_mtime_ns
+            os.utime(path, ns=(mtime + 10 ** 9, mtime + 10 ** 9))
+            response = self.request(self.base_url + '/test.txt',
+                headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(gzip.decompress(response.read()), self.data)
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+            # so is the result of another compression level
+            self.request_handler.compression_level = 2
+            response = self.request(self.base_url + '/test.txt',
+                headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(gzip.decompress(response.read()), self.data)
+            self.assertEqual(len(os.listdir(cache_dir)), 4)
+
+            # compression still works if the cache directory doesn't exist
+            self.request_handler.cache_dir = os.path.join(cache_dir, 'dummy')
+            response = self.request(self.base_url + '/test.txt',
+                headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(gzip.decompress(response.read()), self.data)
+        finally:
+            self.request_handler.cache_dir = None
+            if 'compression_level' in vars(self.request_handler):
+                del self.request_handler.compression_level
+
+    @unittest.skipIf(brotli is None, 'brotli is not available')
+    def test_brotli(self):
+        for ext in self.compressible_ext:
+            response = self.request(self.base_url + '/test.{}'.format(ext),
+                headers={'Accept-Encoding': 'br'})
+            self.assertEqual(response.headers['Content-Encoding'], 'br')
+            self.assertEqual(brotli.decompress(response.read()), self.data)
+
+        response = self.request(self.base_url + '/test_big.txt',
+            headers={'Accept-Encoding': 'br'})
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.read()),
+            self.repeat * self.data)
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not available')
+    def test_zstd(self):
+        decompressor = zstandard.ZstdDecompressor()
+        for ext in self.compressible_ext:
+            response = self.request(self.base_url + '/test.{}'.format(ext),
+                headers={'Accept-Encoding': 'zstd'})
+            self.assertEqual(response.headers['Content-Encoding'], 'zstd')
+            self.assertEqual(
+                decompressor.decompressobj().decompress(response.read()),
+                self.data)
+
+        response = self.request(self.base_url + '/test_big.txt',
+            headers={'Accept-Encoding': 'zstd'})
+        self.assertEqual(response.headers['Content-Encoding'], 'zstd')
+        self.assertEqual(
+            decompressor.decompressobj().decompress(response.read()),
+            self.repeat * self.data)
+
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_encoding_preference(self):
+        # the encoding with highest quality is used
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        response.read()
+
+        # for equal qualities, the order of "compressions" is used
+        first = next(enc for enc in self.request_handler.compressions
+            if enc in ('gzip', 'deflate'))
+        for accept in ('gzip, deflate', 'deflate, gzip'):
+            response = self.request(self.base_url + '/test.txt',
+                headers={'Accept-Encoding': accept})
+            self.assertEqual(response.headers['Content-Encoding'], first)
+            response.read()
+
     @unittest.skipIf(zlib is None, 'zlib is not available')
     def test_header_set_to_wrong_value_supported_extension(self):
         # Content-Encoding header set to a value that doesn't include gzip,
@@ -721,6 +932,35 @@ class HTTPCompressionTestCase(BaseTestCase):
                 headers={'Accept-Encoding': 'dummy'})
             self.assertNotIn('Content-Encoding', response.headers)
 
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_star_with_refused_encoding(self):
+        # "*" doesn't select an encoding refused explicitly
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': 'gzip;q=0, *'})
+        encoding = response.headers['Content-Encoding']
+        self.assertIn(encoding, self.request_handler.compressions)
+        self.assertNotEqual(encoding, 'gzip')
+        if encoding == 'deflate':
+            self.assertEqual(zlib.decompress(response.read()), self.data)
+
+        # refusing gzip also refuses its alias x-gzip
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': 'gzip;q=0, deflate;q=0, *'})
+        encoding = response.headers['Content-Encoding']
+        self.assertNotIn(encoding, ('gzip', 'x-gzip', 'deflate'))
+        if encoding is None:
+            self.assertEqual(response.read(), self.data)
+        else:
+            response.read()
+
+        # no encoding is used if all of them are refused
+        refused = ', '.join(f'{enc};q=0'
+            for enc in self.request_handler.compressions)
+        response = self.request(self.base_url + '/test.txt',
+            headers={'Accept-Encoding': refused + ', *'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.read(), self.data)
+
     @unittest.skipIf(bz2 is None, 'bz2 is not available')
     def test_user_defined_compressions(self):
         # test with encoding "bzip2" instead of "gzip"
@@ -770,6 +1010,25 @@ class HTTPCompressionChunkedTransferTestCase(HTTPCompressionTestCase):
         compressed_types = ["text/plain", "text/html", "text/css", "text/xml",
             "text/javascript", "application/javascript", "application/json"]
 
+    def test_keep_alive(self):
+        # a directory listing sent after a small file on the same
+        # connection is not truncated to the size of the file
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+        connection = http.client.HTTPConnection(self.HOST, self.PORT,
+            timeout=5)
+        try:
+            connection.request('GET', self.base_url + '/tiny.txt')
+            response = connection.getresponse()
+            self.assertEqual(response.read(), self.tiny_data)
+            connection.request('GET', self.base_url + '/sub/')
+            response = connection.getresponse()
+            body = response.read()
+        finally:
+            # the server handles the connection until it is closed
+            connection.close()
+        self.assertEqual(response.headers['Content-Length'], str(len(body)))
+        self.assertIn(b'Directory listing', body)
+
     @unittest.skipIf(zlib is None, 'zlib is not available')
     def test_header_set_supported_extension(self):
         # with protocol set to HTTP/1.1, big files are sent with
@@ -782,6 +1041,23 @@ class HTTPCompressionChunkedTransferTestCase(HTTPCompressionTestCase):
             self.assertEqual(gzip.decompress(response.read()),
                 self.repeat * self.data)
 
+    @unittest.skipIf(zlib is None, 'zlib is not available')
+    def test_buffered_file(self):
+        # files smaller than max_buffered_size are sent with Content-Length,
+        # even if their compressed content is produced in several pieces
+        repeat = self.request_handler.max_buffered_size // len(self.data) - 1
+        path = os.path.join(self.tempdir, 'test_medium.txt')
+        with open(path, 'wb') as temp:
+            temp.write(repeat * self.data)
+        response = self.request(self.base_url + '/test_medium.txt',
+            headers={'Accept-Encoding': 'gzip', 'Connection': 'close'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Transfer-Encoding', response.headers)
+        content = response.read()
+        self.assertEqual(response.headers['Content-Length'],
+            str(len(content)))
+        self.assertEqual(gzip.decompress(content), repeat * self.data)
+
 
 cgi_file1 = """\
 #!%s
@@ -1332,6 +1608,88 @@ class SimpleHTTPRequestHandlerTestCase(unittest.TestCase):
             self.assertEqual(path, self.translated)
 
 
+class AcceptEncodingTestCase(unittest.TestCase):
+    """ Test parsing of the Accept-Encoding header """
+
+    def test_parse(self):
+        parse = server._parse_accept_encoding
+        self.assertEqual(parse(''), {})
+        self.assertEqual(parse('gzip'), {'gzip': 1})
+        self.assertEqual(parse('gzip, deflate, br'),
+            {'gzip': 1, 'deflate': 1, 'br': 1})
+        self.assertEqual(parse('gzip;q=0.8, deflate ; q = 0.5'),
+            {'gzip': 0.8, 'deflate': 0.5})
+        # refused encodings have quality 0, invalid qualities are ignored
+        self.assertEqual(parse('gzip;q=0, *;q=0, br;q=abc'),
+            {'gzip': 0, '*': 0})
+        # empty qualities default to 1, quoted qualities are unquoted
+        self.assertEqual(parse('gzip;q='), {'gzip': 1})
+        self.assertEqual(parse('gzip;q="0.5"'), {'gzip': 0.5})
+        # other parameters are ignored
+        self.assertEqual(parse('gzip;level=1'), {'gzip': 1})
+        # the highest quality is kept for repeated encodings
+        self.assertEqual(parse('gzip;q=0.2,, gzip;q=0.7'), {'gzip': 0.7})
+
+
+class CachingProducerTestCase(unittest.TestCase):
+    """ Test errors when writing compressed data to the cache """
+
+    class FullDisk(io.RawIOBase):
+        def writable(self):
+            return True
+
+        def write(self, data):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+    def test_write_error(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        chunks = [5000 * bytes([i]) for i in range(4)]
+
+        def failing_open(fd, mode):
+            os.close(fd)
+            return io.BufferedWriter(self.FullDisk())
+
+        with mock.patch.object(server, 'open', failing_open, create=True):
+            producer = server._caching_producer((c for c in chunks),
+                os.path.join(cache_dir, 'key'))
+            # all the data is produced, without being cached
+            self.assertEqual(list(producer), chunks)
+        self.assertEqual(os.listdir(cache_dir), [])
+
+
+class WriteBuffersTestCase(unittest.TestCase):
+    """ Test writing of chunks with sendmsg() """
+
+    class PartialSocket(socket.socket):
+        # socket that sends at most 5 bytes per call to sendmsg()
+        def sendmsg(self, buffers):
+            return super().sendmsg([b''.join(buffers)[:5]])
+
+    @unittest.skipUnless(hasattr(socket.socket, 'sendmsg'),
+        'sendmsg() is not available')
+    def test_partial_writes(self):
+        left, right = socket.socketpair()
+        sock = self.PartialSocket(fileno=left.detach())
+        self.addCleanup(sock.close)
+        self.addCleanup(right.close)
+        handler = SocketlessRequestHandler()
+        handler.connection = sock
+        handler.wfile = BytesIO()
+        chunks = [b'We are', b'the knights', b'who say Ni!', b'']
+        for chunk in chunks:
+            handler._write_buffers(handler._make_chunk(chunk))
+        sock.shutdown(socket.SHUT_WR)
+        received = b''
+        while True:
+            data = right.recv(1024)
+            if not data:
+                break
+            received += data
+        self.assertEqual(received, b'6\r\nWe are\r\nB\r\nthe knights\r\n'
+            b'B\r\nwho say Ni!\r\n0\r\n\r\n')
+
+
 class MiscTestCase(unittest.TestCase):
     def test_all(self):
         expected = []
@@ -1356,6 +1714,9 @@ def test_main(verbose=None):
             SimpleHTTPServerTestCase,
             CGIHTTPServerTestCase,
             SimpleHTTPRequestHandlerTestCase,
+            AcceptEncodingTestCase,
+            CachingProducerTestCase,
+            WriteBuffersTestCase,
             MiscTestCase,
             HTTPCompressionTestCase,
             HTTPCompressionChunkedTransferTestCase